@@ -1,12 +1,13 @@
 from __future__ import annotations
 
+import contextlib
 import os
+import queue
 import sqlite3
 import threading
 import time
-from datetime import datetime, timezone
 
-from sopel import plugin
+from sopel import plugin, tools
 from sopel.config.types import BooleanAttribute, FilenameAttribute, ListAttribute, StaticSection
 
 
@@ -22,12 +23,99 @@ class ChannelStatsSection(StaticSection):
 	default_enabled = BooleanAttribute("default_enabled", default=False)
 
 
+LOGGER = tools.get_logger("monitor")
+
+# SQL issued per message/command, kept as constants so the statement cache always hits
+_SQL_SELECT_ELIGIBLE = "SELECT channel FROM eligible_channels"
+_SQL_UPSERT_ELIGIBLE = """
+INSERT INTO eligible_channels(channel, added_by, updated_at)
+VALUES(?, ?, ?)
+ON CONFLICT(channel) DO UPDATE SET
+	added_by = excluded.added_by,
+	updated_at = excluded.updated_at
+"""
+_SQL_SELECT_ENABLED = "SELECT enabled FROM enabled_channels WHERE channel = ?"
+_SQL_UPSERT_ENABLED = """
+INSERT INTO enabled_channels(channel, enabled, updated_at)
+VALUES(?, ?, ?)
+ON CONFLICT(channel) DO UPDATE SET
+	enabled = excluded.enabled,
+	updated_at = excluded.updated_at
+"""
+_SQL_UPSERT_STATS = """
+INSERT INTO stats(channel, nick, messages, first_seen, last_seen)
+VALUES(?1, ?2, ?3, ?4, ?4)
+ON CONFLICT(channel, nick) DO UPDATE SET
+	messages = messages + excluded.messages,
+	last_seen = max(last_seen, excluded.last_seen)
+"""
+# Top 10 and bottom 10 of a channel in one pass; rows carry both ranks
+_SQL_SELECT_LEADERBOARD = """
+WITH ranked AS (
+	SELECT
+		nick,
+		messages,
+		ROW_NUMBER() OVER (ORDER BY messages DESC, nick ASC) AS r_desc,
+		ROW_NUMBER() OVER (ORDER BY messages ASC, nick ASC) AS r_asc
+	FROM stats
+	WHERE channel = ?
+)
+SELECT nick, messages, r_desc, r_asc
+FROM ranked
+WHERE r_desc <= 10 OR r_asc <= 10
+"""
+_SQL_SELECT_USER = """
+SELECT messages, first_seen, last_seen
+FROM stats
+WHERE channel = ? AND nick = ?
+"""
+
+# Serializes use of _WRITER_CONN; readers don't take it (WAL lets them run alongside the writer)
 _DB_LOCK = threading.Lock()
 
+# Single connection for all writes (batch flusher and admin commands)
+_WRITER_CONN: sqlite3.Connection | None = None
+# Pre-opened connections for queries, checked out via _reader()
+_READER_POOL_SIZE = 4
+_READERS: queue.Queue[sqlite3.Connection] = queue.Queue()
+
+# Unflushed message counts per (channel, nick); timestamped once per flush
+_PENDING: dict[tuple[str, str], int] = {}
+_PENDING_LOCK = threading.Lock()
+# Seconds between flushes of _PENDING by the background writer thread
+_FLUSH_INTERVAL = 10.0
+_WRITER_STOP = threading.Event()
+_WRITER: threading.Thread | None = None
+
+# Seconds an enabled lookup is served from memory before re-reading the DB
+_CACHE_TTL = 30.0
+_CACHE_LOCK = threading.Lock()
+# Config + DB eligible channels; rebuilt on setup, on runtime adds, and after _ELIGIBLE_TTL
+_ELIGIBLE_SNAPSHOT: frozenset[str] = frozenset()
+_ELIGIBLE_SNAPSHOT_TS = float("-inf")
+_ELIGIBLE_TTL = 60.0
+# channel -> (monotonic time cached, enabled)
+_ENABLED_CACHE: dict[str, tuple[float, bool]] = {}
+
+# Monitoring state of a channel, as returned by _state()
+_STATE_NOT_ELIGIBLE = 0
+_STATE_DISABLED = 1
+_STATE_ENABLED = 2
+
 
 def setup(bot):
 	bot.config.define_section("channelstats", ChannelStatsSection)
-	_init_db(_get_db_path(bot))
+	# Resolved once; nothing on the message path touches os.path
+	_open_pool(_get_db_path(bot))
+	_init_db()
+	_refresh_eligible(bot)
+	_start_writer()
+
+
+def shutdown(bot):
+	# Flush pending message counters before closing connections
+	_stop_writer()
+	_close_pool()
 
 
 def _get_db_path(bot) -> str:
@@ -47,62 +135,112 @@ def _get_db_path(bot) -> str:
 
 
 def _connect(db_path: str) -> sqlite3.Connection:
-	conn = sqlite3.connect(db_path, timeout=30)
+	conn = sqlite3.connect(
+		db_path,
+		timeout=30,
+		check_same_thread=False,
+		isolation_level=None,
+		cached_statements=256,
+	)
 	conn.execute("PRAGMA journal_mode=WAL;")
 	conn.execute("PRAGMA synchronous=NORMAL;")
+	# busy_timeout is already 30s via timeout= above
+	conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB page cache
+	conn.execute("PRAGMA temp_store=MEMORY;")
+	conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
 	return conn
 
 
-def _init_db(db_path: str) -> None:
+def _open_pool(db_path: str) -> None:
+	global _WRITER_CONN
+	if _WRITER_CONN is not None:
+		return
+	_WRITER_CONN = _connect(db_path)
+	for _ in range(_READER_POOL_SIZE):
+		_READERS.put(_connect(db_path))
+
+
+def _close_pool() -> None:
+	global _WRITER_CONN
+	conns = [] if _WRITER_CONN is None else [_WRITER_CONN]
+	_WRITER_CONN = None
+	while True:
+		try:
+			conns.append(_READERS.get_nowait())
+		except queue.Empty:
+			break
+	for conn in conns:
+		try:
+			conn.close()
+		except sqlite3.Error:
+			pass
+
+
+@contextlib.contextmanager
+def _write_txn():
+	# Take the write lock up front so the transaction can't fail late with SQLITE_BUSY
 	with _DB_LOCK:
-		conn = _connect(db_path)
+		conn = _WRITER_CONN
+		conn.execute("BEGIN IMMEDIATE")
 		try:
-			conn.execute(
-				"""
-				CREATE TABLE IF NOT EXISTS stats (
-					channel TEXT NOT NULL,
-					nick TEXT NOT NULL,
-					messages INTEGER NOT NULL DEFAULT 0,
-					first_seen INTEGER NOT NULL,
-					last_seen INTEGER NOT NULL,
-					PRIMARY KEY(channel, nick)
-				)
-				"""
-			)
-			conn.execute(
-				"""
-				CREATE TABLE IF NOT EXISTS enabled_channels (
-					channel TEXT PRIMARY KEY,
-					enabled INTEGER NOT NULL,
-					updated_at INTEGER NOT NULL
-				)
-				"""
+			yield conn
+			conn.execute("COMMIT")
+		except BaseException:
+			# SQLite may already have rolled back on its own; don't mask the original error
+			if conn.in_transaction:
+				conn.execute("ROLLBACK")
+			raise
+
+
+@contextlib.contextmanager
+def _reader():
+	conn = _READERS.get(timeout=30)
+	try:
+		yield conn
+	finally:
+		_READERS.put(conn)
+
+
+def _init_db() -> None:
+	with _write_txn() as conn:
+		conn.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS stats (
+				channel TEXT NOT NULL,
+				nick TEXT NOT NULL,
+				messages INTEGER NOT NULL DEFAULT 0,
+				first_seen INTEGER NOT NULL,
+				last_seen INTEGER NOT NULL,
+				PRIMARY KEY(channel, nick)
 			)
-			conn.execute(
-				"CREATE INDEX IF NOT EXISTS idx_stats_channel_messages ON stats(channel, messages DESC)"
+			"""
+		)
+		conn.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS enabled_channels (
+				channel TEXT PRIMARY KEY,
+				enabled INTEGER NOT NULL,
+				updated_at INTEGER NOT NULL
 			)
-			conn.execute(
-				"""
-				CREATE TABLE IF NOT EXISTS eligible_channels (
-					channel TEXT PRIMARY KEY,
-					added_by TEXT,
-					updated_at INTEGER NOT NULL
-				)
-				"""
+			"""
+		)
+		# Leaderboards sort a channel's rows on demand; an index on messages would be
+		# rewritten on every flush. Drop it from databases created by older versions.
+		conn.execute("DROP INDEX IF EXISTS idx_stats_channel_messages")
+		conn.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS eligible_channels (
+				channel TEXT PRIMARY KEY,
+				added_by TEXT,
+				updated_at INTEGER NOT NULL
 			)
-			conn.commit()
-		finally:
-			conn.close()
+			"""
+		)
 
 
 def _db_eligible_channels(bot) -> set[str]:
-	db_path = _get_db_path(bot)
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			rows = conn.execute("SELECT channel FROM eligible_channels").fetchall()
-		finally:
-			conn.close()
+	with _reader() as conn:
+		rows = conn.execute(_SQL_SELECT_ELIGIBLE).fetchall()
 	return {r[0].strip().lower() for r in rows if r and r[0]}
 
 
@@ -111,116 +249,202 @@ def _add_db_eligible_channel(bot, channel: str, added_by: str | None = None) ->
 	if not channel.startswith("#"):
 		return
 	ts = int(time.time())
-	db_path = _get_db_path(bot)
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			conn.execute(
-				"""
-				INSERT INTO eligible_channels(channel, added_by, updated_at)
-				VALUES(?, ?, ?)
-				ON CONFLICT(channel) DO UPDATE SET
-					added_by = excluded.added_by,
-					updated_at = excluded.updated_at
-				""",
-				(channel, added_by, ts),
-			)
-			conn.commit()
-		finally:
-			conn.close()
+	with _write_txn() as conn:
+		conn.execute(
+			_SQL_UPSERT_ELIGIBLE,
+			(channel, added_by, ts),
+		)
+	_refresh_eligible(bot)
 
 
-def _eligible_channels(bot) -> set[str]:
+def _refresh_eligible(bot) -> frozenset[str]:
+	global _ELIGIBLE_SNAPSHOT, _ELIGIBLE_SNAPSHOT_TS
+	now = time.monotonic()
 	chans = list(bot.config.channelstats.channels or [])
 	from_config = {c.strip().lower() for c in chans if c and c.strip().startswith("#")}
 	# Merge in channels added at runtime (persisted in plugin DB)
-	return from_config | _db_eligible_channels(bot)
+	eligible = frozenset(from_config | _db_eligible_channels(bot))
+	with _CACHE_LOCK:
+		# A refresh that started after this read (e.g. from a runtime add) already
+		# stored a newer snapshot; don't replace it with this older one
+		if _ELIGIBLE_SNAPSHOT_TS > now:
+			return _ELIGIBLE_SNAPSHOT
+		_ELIGIBLE_SNAPSHOT = eligible
+		_ELIGIBLE_SNAPSHOT_TS = now
+	return eligible
+
+
+def _eligible_channels(bot) -> frozenset[str]:
+	if time.monotonic() - _ELIGIBLE_SNAPSHOT_TS < _ELIGIBLE_TTL:
+		return _ELIGIBLE_SNAPSHOT
+	# Safety net in case the DB was changed outside this process
+	return _refresh_eligible(bot)
 
 
 def _is_enabled(bot, channel: str) -> bool:
-	channel = channel.lower()
+	# `channel` must already be lowercased
+	now = time.monotonic()
+	cached = _ENABLED_CACHE.get(channel)
+	if cached is not None and now - cached[0] < _CACHE_TTL:
+		return cached[1]
+
+	enabled = _read_enabled(bot, channel)
+	with _CACHE_LOCK:
+		_cache_enabled_locked(channel, now, enabled)
+	return enabled
+
+
+def _cache_enabled_locked(channel: str, read_at: float, enabled: bool) -> None:
+	# Caller holds _CACHE_LOCK. `read_at` is taken before the DB read, so an entry
+	# stored after it (e.g. by _set_enabled) is newer and must not be overwritten.
+	existing = _ENABLED_CACHE.get(channel)
+	if existing is None or existing[0] <= read_at:
+		_ENABLED_CACHE[channel] = (read_at, enabled)
+
+
+def _read_enabled(bot, channel: str) -> bool:
 	default_enabled = bool(bot.config.channelstats.default_enabled)
 
-	db_path = _get_db_path(bot)
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			row = conn.execute(
-				"SELECT enabled FROM enabled_channels WHERE channel = ?",
-				(channel,),
-			).fetchone()
-		finally:
-			conn.close()
+	with _reader() as conn:
+		row = conn.execute(
+			_SQL_SELECT_ENABLED,
+			(channel,),
+		).fetchone()
 
 	if row is None:
 		return default_enabled
 	return bool(row[0])
 
 
+def _enabled_channels(bot, channels) -> set[str]:
+	# Bulk _is_enabled: one query for all of `channels` (already lowercased)
+	channels = list(channels)
+	if not channels:
+		return set()
+	default_enabled = bool(bot.config.channelstats.default_enabled)
+
+	placeholders = ", ".join("?" * len(channels))
+	now = time.monotonic()
+	with _reader() as conn:
+		rows = conn.execute(
+			f"SELECT channel, enabled FROM enabled_channels WHERE channel IN ({placeholders})",
+			channels,
+		).fetchall()
+
+	explicit = {channel: bool(enabled) for channel, enabled in rows}
+	with _CACHE_LOCK:
+		for channel in channels:
+			_cache_enabled_locked(channel, now, explicit.get(channel, default_enabled))
+	return {c for c in channels if explicit.get(c, default_enabled)}
+
+
 def _set_enabled(bot, channel: str, enabled: bool) -> None:
 	channel = channel.lower()
 	ts = int(time.time())
-	db_path = _get_db_path(bot)
+	with _write_txn() as conn:
+		conn.execute(
+			_SQL_UPSERT_ENABLED,
+			(channel, 1 if enabled else 0, ts),
+		)
+	# Stamped after the commit, so lookups that read the old row before it
+	# won't replace this entry (see _cache_enabled_locked)
+	with _CACHE_LOCK:
+		_ENABLED_CACHE[channel] = (time.monotonic(), enabled)
+
+
+def _state(bot, channel: str) -> int:
+	# `channel` must already be lowercased
+	if channel not in _eligible_channels(bot):
+		return _STATE_NOT_ELIGIBLE
+	return _STATE_ENABLED if _is_enabled(bot, channel) else _STATE_DISABLED
+
+
+def _touch_message(bot, channel: str, nick: str) -> None:
+	# No SQLite work on the IRC thread; the writer thread flushes these.
+	# `channel` must already be lowercased. Key on the exact nick string: a Sopel
+	# Identifier hashes case-insensitively, but stats rows are case-sensitive.
+	key = (channel, str(nick))
+	with _PENDING_LOCK:
+		_PENDING[key] = _PENDING.get(key, 0) + 1
+
+
+def _merge_pending(pending: dict[tuple[str, str], int]) -> None:
+	# Put counts back after a failed flush so they are retried next time
+	with _PENDING_LOCK:
+		for key, messages in pending.items():
+			_PENDING[key] = _PENDING.get(key, 0) + messages
+
+
+def _write_batch(rows: list[tuple[str, str, int, int]]) -> None:
+	with _write_txn() as conn:
+		conn.executemany(
+			_SQL_UPSERT_STATS,
+			rows,
+		)
+
+
+def _flush_pending() -> None:
+	global _PENDING
+	with _PENDING_LOCK:
+		pending, _PENDING = _PENDING, {}
+	if not pending:
+		return
 
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			conn.execute(
-				"""
-				INSERT INTO enabled_channels(channel, enabled, updated_at)
-				VALUES(?, ?, ?)
-				ON CONFLICT(channel) DO UPDATE SET
-					enabled = excluded.enabled,
-					updated_at = excluded.updated_at
-				""",
-				(channel, 1 if enabled else 0, ts),
-			)
-			conn.commit()
-		finally:
-			conn.close()
+	# One timestamp for the whole batch; first/last_seen are accurate to the flush interval
+	ts = int(time.time())
+	rows = [(channel, nick, messages, ts) for (channel, nick), messages in pending.items()]
+	try:
+		_write_batch(rows)
+	except sqlite3.Error:
+		LOGGER.exception("Failed to flush stats for %d nicks; will retry", len(rows))
+		_merge_pending(pending)
 
 
-def _is_monitored(bot, channel: str) -> bool:
-	channel = channel.lower()
-	return channel in _eligible_channels(bot) and _is_enabled(bot, channel)
+def _writer_loop() -> None:
+	while not _WRITER_STOP.wait(_FLUSH_INTERVAL):
+		_flush_pending()
+	# Final synchronous flush on shutdown
+	_flush_pending()
 
 
-def _touch_message(bot, channel: str, nick: str, ts: int) -> None:
-	db_path = _get_db_path(bot)
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			conn.execute(
-				"""
-				INSERT INTO stats(channel, nick, messages, first_seen, last_seen)
-				VALUES(?, ?, 1, ?, ?)
-				ON CONFLICT(channel, nick) DO UPDATE SET
-					messages = messages + 1,
-					last_seen = excluded.last_seen
-				""",
-				(channel.lower(), nick, ts, ts),
-			)
-			conn.commit()
-		finally:
-			conn.close()
+def _start_writer() -> None:
+	global _WRITER
+	if _WRITER is not None and _WRITER.is_alive():
+		return
+	_WRITER_STOP.clear()
+	_WRITER = threading.Thread(
+		target=_writer_loop,
+		name="monitor-writer",
+		daemon=True,
+	)
+	_WRITER.start()
+
+
+def _stop_writer() -> None:
+	global _WRITER
+	if _WRITER is None:
+		return
+	_WRITER_STOP.set()
+	_WRITER.join()
+	_WRITER = None
 
 
 @plugin.event("PRIVMSG")
 @plugin.rule(".*")
 @plugin.require_chanmsg
 def track_messages(bot, trigger):
-	channel = trigger.sender
-	if not _is_monitored(bot, channel):
-		return
+	# Identifier comparison, so this is already case-insensitive
 	if trigger.nick == bot.nick:
 		return
+	channel = trigger.sender.lower()
+	if _state(bot, channel) != _STATE_ENABLED:
+		return
 
-	_touch_message(bot, channel, trigger.nick, int(time.time()))
+	_touch_message(bot, channel, trigger.nick)
 
 
 def _format_ts(ts: int) -> str:
-	dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-	return dt.strftime("%Y-%m-%d %H:%M:%S UTC")
+	return time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(ts))
 
 
 @plugin.commands("monitor")
@@ -243,7 +467,7 @@ def monitor_control(bot, trigger):
 	eligible = _eligible_channels(bot)
 
 	if sub == "list":
-		enabled = sorted([c for c in eligible if _is_enabled(bot, c)])
+		enabled = sorted(_enabled_channels(bot, eligible))
 		if not enabled:
 			bot.reply("No channels enabled for monitoring.")
 		else:
@@ -287,38 +511,23 @@ def monitor_control(bot, trigger):
 @plugin.commands("channelstats")
 @plugin.require_chanmsg
 def channelstats(bot, trigger):
-	channel = trigger.sender
-	if not _is_monitored(bot, channel):
+	channel = trigger.sender.lower()
+	state = _state(bot, channel)
+	if state == _STATE_NOT_ELIGIBLE:
+		bot.say("This channel is not eligible for monitoring.")
+		return
+	if state == _STATE_DISABLED:
 		bot.say("Monitoring is not enabled in this channel.")
 		return
 
-	db_path = _get_db_path(bot)
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			top = conn.execute(
-				"""
-				SELECT nick, messages
-				FROM stats
-				WHERE channel = ?
-				ORDER BY messages DESC, nick ASC
-				LIMIT 10
-				""",
-				(channel.lower(),),
-			).fetchall()
-
-			bottom = conn.execute(
-				"""
-				SELECT nick, messages
-				FROM stats
-				WHERE channel = ?
-				ORDER BY messages ASC, nick ASC
-				LIMIT 10
-				""",
-				(channel.lower(),),
-			).fetchall()
-		finally:
-			conn.close()
+	with _reader() as conn:
+		rows = conn.execute(
+			_SQL_SELECT_LEADERBOARD,
+			(channel,),
+		).fetchall()
+
+	top = [(n, c) for n, c, r_desc, _ in sorted(rows, key=lambda r: r[2]) if r_desc <= 10]
+	bottom = [(n, c) for n, c, _, r_asc in sorted(rows, key=lambda r: r[3]) if r_asc <= 10]
 
 	if not top:
 		bot.say("No stats yet for this channel.")
@@ -337,26 +546,22 @@ def channelstats(bot, trigger):
 @plugin.require_chanmsg
 def userstats(bot, trigger):
 	channel = trigger.sender
-	if not _is_monitored(bot, channel):
+	channel_l = channel.lower()
+	state = _state(bot, channel_l)
+	if state == _STATE_NOT_ELIGIBLE:
+		bot.say("This channel is not eligible for monitoring.")
+		return
+	if state == _STATE_DISABLED:
 		bot.say("Monitoring is not enabled in this channel.")
 		return
 
 	nick = (trigger.group(2) or "").strip() or trigger.nick
 
-	db_path = _get_db_path(bot)
-	with _DB_LOCK:
-		conn = _connect(db_path)
-		try:
-			row = conn.execute(
-				"""
-				SELECT messages, first_seen, last_seen
-				FROM stats
-				WHERE channel = ? AND nick = ?
-				""",
-				(channel.lower(), nick),
-			).fetchone()
-		finally:
-			conn.close()
+	with _reader() as conn:
+		row = conn.execute(
+			_SQL_SELECT_USER,
+			(channel_l, nick),
+		).fetchone()
 
 	if not row:
 		bot.say(f"No stats for {nick} in {channel} yet.")
@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sopel")
+from sopel.tools import Identifier  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import monitor  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+	path = str(tmp_path / "monitor.db")
+	monitor._open_pool(path)
+	monitor._init_db()
+	yield path
+	monitor._PENDING.clear()
+	monitor._ENABLED_CACHE.clear()
+	monitor._ELIGIBLE_SNAPSHOT = frozenset()
+	monitor._ELIGIBLE_SNAPSHOT_TS = float("-inf")
+	monitor._close_pool()
+
+
+@pytest.fixture
+def bot():
+	section = SimpleNamespace(channels=["#a"], default_enabled=False)
+	return SimpleNamespace(config=SimpleNamespace(channelstats=section))
+
+
+def _counts(db_path):
+	conn = sqlite3.connect(db_path)
+	try:
+		return dict(conn.execute("SELECT nick, messages FROM stats WHERE channel = '#a'"))
+	finally:
+		conn.close()
+
+
+def test_mixed_case_nicks_are_counted_separately(db_path):
+	for nick in ["Foo", "foo", "Foo", "bar"]:
+		monitor._touch_message(None, "#a", Identifier(nick))
+	monitor._flush_pending()
+
+	assert _counts(db_path) == {"Foo": 2, "foo": 1, "bar": 1}
+
+	# Across flush windows the rows stay separate regardless of who spoke first
+	for nick in ["foo", "Foo"]:
+		monitor._touch_message(None, "#a", Identifier(nick))
+	monitor._flush_pending()
+
+	assert _counts(db_path) == {"Foo": 3, "foo": 2, "bar": 1}
+
+
+def test_set_enabled_wins_over_concurrent_cache_miss(db_path, bot, monkeypatch):
+	monitor._set_enabled(bot, "#a", True)
+	monitor._ENABLED_CACHE.clear()
+
+	read_done = threading.Event()
+	proceed = threading.Event()
+	real_read = monitor._read_enabled
+
+	def slow_read(bot, channel):
+		# Read the old row, then stall before _is_enabled stores it in the cache
+		enabled = real_read(bot, channel)
+		read_done.set()
+		proceed.wait(5)
+		return enabled
+
+	monkeypatch.setattr(monitor, "_read_enabled", slow_read)
+	reader = threading.Thread(target=monitor._is_enabled, args=(bot, "#a"))
+	reader.start()
+	assert read_done.wait(5)
+	monitor._set_enabled(bot, "#a", False)
+	proceed.set()
+	reader.join(5)
+
+	assert monitor._is_enabled(bot, "#a") is False
+
+
+def _insert_enabled(conn, channel):
+	conn.execute(
+		"INSERT INTO enabled_channels(channel, enabled, updated_at) VALUES(?, 1, 0)",
+		(channel,),
+	)
+
+
+def test_write_txn_rolls_back_on_error(db_path):
+	with pytest.raises(RuntimeError):
+		with monitor._write_txn() as conn:
+			_insert_enabled(conn, "#a")
+			raise RuntimeError("boom")
+
+	assert monitor._WRITER_CONN.in_transaction is False
+	with monitor._write_txn() as conn:
+		_insert_enabled(conn, "#b")
+
+	rows = monitor._WRITER_CONN.execute("SELECT channel FROM enabled_channels").fetchall()
+	assert rows == [("#b",)]
+
+
+def test_write_txn_recovers_from_failed_commit(db_path, monkeypatch):
+	real = monitor._WRITER_CONN
+
+	class FailCommitOnce:
+		failed = False
+
+		def __getattr__(self, name):
+			return getattr(real, name)
+
+		def execute(self, sql, *args):
+			if sql == "COMMIT" and not self.failed:
+				self.failed = True
+				raise sqlite3.OperationalError("commit failed")
+			return real.execute(sql, *args)
+
+	monkeypatch.setattr(monitor, "_WRITER_CONN", FailCommitOnce())
+	with pytest.raises(sqlite3.OperationalError):
+		with monitor._write_txn() as conn:
+			_insert_enabled(conn, "#a")
+
+	assert real.in_transaction is False
+	with monitor._write_txn() as conn:
+		_insert_enabled(conn, "#b")
+	assert real.execute("SELECT channel FROM enabled_channels").fetchall() == [("#b",)]
+
+
+def test_failed_flush_keeps_counts_for_retry(db_path, monkeypatch):
+	for nick in ["Foo", "Foo", "bar"]:
+		monitor._touch_message(None, "#a", Identifier(nick))
+
+	def failing_write(rows):
+		raise sqlite3.OperationalError("database is locked")
+
+	monkeypatch.setattr(monitor, "_write_batch", failing_write)
+	monitor._flush_pending()
+	assert monitor._PENDING == {("#a", "Foo"): 2, ("#a", "bar"): 1}
+
+	# Messages arriving before the retry are added on top
+	monitor._touch_message(None, "#a", Identifier("Foo"))
+	monkeypatch.undo()
+	monitor._flush_pending()
+
+	assert monitor._PENDING == {}
+	assert _counts(db_path) == {"Foo": 3, "bar": 1}
+
+
+def test_stats_commands_distinguish_not_eligible_from_disabled(db_path, bot):
+	replies = []
+	bot.say = replies.append
+	monitor._refresh_eligible(bot)
+
+	def trigger(channel):
+		return SimpleNamespace(
+			sender=channel,
+			nick=Identifier("someone"),
+			is_privmsg=False,
+			group=lambda n: None,
+		)
+
+	monitor.channelstats(bot, trigger("#elsewhere"))
+	monitor.userstats(bot, trigger("#elsewhere"))
+	monitor.channelstats(bot, trigger("#a"))
+	monitor.userstats(bot, trigger("#a"))
+	monitor._set_enabled(bot, "#a", True)
+	monitor.channelstats(bot, trigger("#a"))
+
+	assert replies == [
+		"This channel is not eligible for monitoring.",
+		"This channel is not eligible for monitoring.",
+		"Monitoring is not enabled in this channel.",
+		"Monitoring is not enabled in this channel.",
+		"No stats yet for this channel.",
+	]